@@ -1,4 +1,9 @@
+import copy
+import multiprocessing
 import sys
+from collections import Counter, deque
+from functools import partial
+from operator import itemgetter
 
 from crossword import *
 
@@ -10,26 +15,80 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+
+        # Domains stay plain sets of words rather than bitsets, so callers
+        # may read and assign them directly; nothing derived from them is
+        # cached outside of backtracking. Every change made here is a bulk
+        # set operation, whether intersecting with a length bucket,
+        # removing character-index buckets, narrowing to an assigned word,
+        # or restoring removed words from the trail
         self.domains = {
             var: self.crossword.words.copy()
             for var in self.crossword.variables
         }
 
+        # Bumped whenever the search changes a variable's domain, so that
+        # per-position character counts cached during the search can tell
+        # when they are stale
+        self._domain_version = {var: 0 for var in self.crossword.variables}
+        self._char_cache = dict()
+
+        # Vocabulary grouped by word length, for node consistency
+        self._by_length = dict()
+        for word in self.crossword.words:
+            self._by_length.setdefault(len(word), set()).add(word)
+
+        # Index of the vocabulary by character position: for each index k,
+        # map each character to the set of words with that character at k
+        self._index = []
+        for word in self.crossword.words:
+            for k, char in enumerate(word):
+                if k == len(self._index):
+                    self._index.append(dict())
+                self._index[k].setdefault(char, set()).add(word)
+
+        # Neighbors never change during a solve, so compute them once
+        self._neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
+            for var in self.crossword.variables
+        }
+        # For each variable, its (neighbor, own index, neighbor's index)
+        # triples, so overlap checks need no lookups in crossword.overlaps
+        self._overlaps = {
+            var: [
+                (n, *self.crossword.overlaps[var, n])
+                for n in self._neighbors[var]
+            ]
+            for var in self.crossword.variables
+        }
+        self._degree = {
+            var: len(self._neighbors[var]) for var in self.crossword.variables
+        }
+        self._n_vars = len(self.crossword.variables)
+
+        # Positions of each variable's cells in a row-major flattened grid
+        self._flat_cells = {
+            var: [i * self.crossword.width + j for i, j in var.cells]
+            for var in self.crossword.variables
+        }
+
+        # Undo stack of (variable, removed words) records; None marks the
+        # start of each backtracking branch. Left empty outside of search
+        self._trail = []
+
     def letter_grid(self, assignment):
         """
         Return 2D array representing a given assignment.
         """
-        letters = [
-            [None for _ in range(self.crossword.width)]
-            for _ in range(self.crossword.height)
-        ]
+        width = self.crossword.width
+        letters = [None] * (width * self.crossword.height)
         for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
-        return letters
+            for cell, letter in zip(self._flat_cells[variable], word):
+                letters[cell] = letter
+        return [
+            letters[i * width:(i + 1) * width]
+            for i in range(self.crossword.height)
+        ]
 
     def print(self, assignment):
         """
@@ -54,34 +113,50 @@ class CrosswordCreator():
         interior_size = cell_size - 2 * cell_border
         letters = self.letter_grid(assignment)
 
-        # Create a blank canvas
-        img = Image.new(
+        # Paint the grid into a single RGBA buffer, one pixel row pattern
+        # per row of cells, matching the inclusive bounds of the rectangles
+        # that PIL draws for each open cell
+        black = bytes((0, 0, 0, 255))
+        white = bytes((255, 255, 255, 255))
+        closed_cell = black * cell_size
+        open_cell = (
+            black * cell_border
+            + white * (interior_size + 1)
+            + black * (cell_border - 1)
+        )
+        border_line = closed_cell * self.crossword.width
+        canvas = []
+        for i in range(self.crossword.height):
+            line = b"".join(
+                open_cell if self.crossword.structure[i][j] else closed_cell
+                for j in range(self.crossword.width)
+            )
+            canvas.append(
+                border_line * cell_border
+                + line * (interior_size + 1)
+                + border_line * (cell_border - 1)
+            )
+        img = Image.frombytes(
             "RGBA",
             (self.crossword.width * cell_size,
              self.crossword.height * cell_size),
-            "black"
+            b"".join(canvas)
         )
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
+        # Only cells holding a letter need a draw call
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
-
-                rect = [
-                    (j * cell_size + cell_border,
-                     i * cell_size + cell_border),
-                    ((j + 1) * cell_size - cell_border,
-                     (i + 1) * cell_size - cell_border)
-                ]
-                if self.crossword.structure[i][j]:
-                    draw.rectangle(rect, fill="white")
-                    if letters[i][j]:
-                        _, _, w, h = draw.textbbox((0, 0), letters[i][j], font=font)
-                        draw.text(
-                            (rect[0][0] + ((interior_size - w) / 2),
-                             rect[0][1] + ((interior_size - h) / 2) - 10),
-                            letters[i][j], fill="black", font=font
-                        )
+                if self.crossword.structure[i][j] and letters[i][j]:
+                    left = j * cell_size + cell_border
+                    top = i * cell_size + cell_border
+                    _, _, w, h = draw.textbbox((0, 0), letters[i][j], font=font)
+                    draw.text(
+                        (left + ((interior_size - w) / 2),
+                         top + ((interior_size - h) / 2) - 10),
+                        letters[i][j], fill="black", font=font
+                    )
 
         img.save(filename)
 
@@ -93,6 +168,35 @@ class CrosswordCreator():
         self.ac3()
         return self.backtrack(dict())
 
+    def solve_parallel(self, max_workers=None):
+        """
+        Enforce node and arc consistency, and then solve the CSP by
+        searching the subtree under each value of the first selected
+        variable in a separate process.
+
+        Return the first complete assignment found, or None if there is
+        no possible assignment.
+        """
+        self.enforce_node_consistency()
+        if not self.ac3(): return None
+        root = self.select_unassigned_variable(dict())
+        if root is None: return dict()
+
+        pool = multiprocessing.Pool(
+            processes=max_workers,
+            initializer=_init_worker, initargs=(self,)
+        )
+        # Leaving the block terminates the workers, so branches still
+        # searching are stopped as soon as one returns a solution
+        with pool:
+            results = pool.imap_unordered(
+                partial(_solve_branch, root),
+                self.order_domain_values(root, dict())
+            )
+            for result in results:
+                if result is not None: return result
+        return None
+
     def enforce_node_consistency(self):
         """
         Update `self.domains` such that each variable is node-consistent.
@@ -101,13 +205,11 @@ class CrosswordCreator():
         """
 
         for variable in self.domains:
-            words_to_remove = set()
-            for word in self.domains[variable]:
-                if len(word) != variable.length:
-                    words_to_remove.add(word)
-            for word in words_to_remove:
-                self.domains[variable].remove(word)
-
+            self.domains[variable] = (
+                self.domains[variable]
+                & self._by_length.get(variable.length, set())
+            )
+            self._domain_version[variable] += 1
 
     def revise(self, x, y):
         """
@@ -125,22 +227,64 @@ class CrosswordCreator():
             return False
 
         i, j = overlap  # Indices where x and y overlap
-        to_remove = []
+        support = self._char_counts(y, j)
+        domain = self.domains[x]
+
+        # Drop, as whole index buckets, the words of `x` whose character
+        # at i never appears at j in the domain of `y`
+        for char in self._char_counts(x, i):
+            if char not in support:
+                removed = domain & self._index[i][char]
+                domain -= removed
+                if self._trail:
+                    self._trail.append((x, removed))
+                revised = True
+
+        if revised:
+            self._domain_version[x] += 1
 
-        for word_x in self.domains[x]:
-            match_found = False
-            for word_y in self.domains[y]:
-                if word_x[i] == word_y[j]:
-                    match_found = True
-                    break
-            if not match_found:
-                to_remove.append(word_x)
+        return revised
 
-        for word in to_remove:
-            self.domains[x].remove(word)
-            revised = True
+    def _char_counts(self, var, k):
+        """
+        Return a Counter of the characters found at index `k` among the
+        words in `self.domains[var]`.
 
-        return revised
+        During backtracking, where every change to the domains goes through
+        this class, the result is cached until the domain of `var` changes.
+        Otherwise callers may have assigned to `self.domains`, so the
+        counts are always rebuilt.
+        """
+        if not self._trail:
+            return Counter(map(itemgetter(k), self.domains[var]))
+
+        key = (var, k)
+        version = self._domain_version[var]
+        cached = self._char_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        counts = Counter(map(itemgetter(k), self.domains[var]))
+        self._char_cache[key] = (version, counts)
+        return counts
+
+    def _push_frame(self):
+        """
+        Start recording domain removals for a new backtracking branch.
+        """
+        self._trail.append(None)
+
+    def _undo_frame(self):
+        """
+        Restore every word removed from the domains since the matching
+        `_push_frame`.
+        """
+        while True:
+            record = self._trail.pop()
+            if record is None: return
+            var, removed = record
+            self.domains[var] |= removed
+            self._domain_version[var] += 1
 
     def ac3(self, arcs=None):
         """
@@ -153,17 +297,21 @@ class CrosswordCreator():
         """
         
         if arcs is None:
-            arcs = [(x, y) for x in self.crossword.variables for y in self.crossword.neighbors(x)]
+            arcs = [(x, y) for x in self.crossword.variables for y in self._neighbors[x]]
 
-        queue = arcs.copy()
+        queue = deque(dict.fromkeys(arcs))  # Drop repeated initial arcs
+        pending = set(queue)  # Arcs currently waiting in the queue
 
         while queue:
-            (x, y) = queue.pop(0)
+            (x, y) = queue.popleft()
+            pending.discard((x, y))
             if self.revise(x, y):
                 if len(self.domains[x]) == 0:
                     return False
-                for neighbor in self.crossword.neighbors(x) - {y}:
-                    queue.append((neighbor, x))
+                for neighbor in self._neighbors[x] - {y}:
+                    if (neighbor, x) not in pending:
+                        queue.append((neighbor, x))
+                        pending.add((neighbor, x))
         
         return True
 
@@ -174,7 +322,7 @@ class CrosswordCreator():
         crossword variable); return False otherwise.
         """
 
-        return not len(set(self.crossword.variables - assignment.keys()))
+        return len(assignment) == self._n_vars
         
 
     def consistent(self, assignment):
@@ -183,16 +331,16 @@ class CrosswordCreator():
         puzzle without conflicting characters); return False otherwise.
         """
         
-        if len(list(assignment.values())) != len(set(assignment.values())): return False
+        if len(assignment) != len(set(assignment.values())): return False
         
         for i in assignment:
             if len(assignment[i]) != i.length: return False
             
+        overlaps = self._overlaps
         for i in assignment:
-            n = self.crossword.neighbors(i)
-            for j in n:
-                if j in set(assignment.keys()):
-                    if assignment[i][self.crossword.overlaps[(i,j)][0]] != assignment[j][self.crossword.overlaps[(i,j)][1]]: return False
+            for j, k, m in overlaps[i]:
+                if j in assignment:
+                    if assignment[i][k] != assignment[j][m]: return False
         
         return True
         
@@ -204,42 +352,23 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        def _neighbor(temp, v):
-            count = 0
-            if temp not in assignment:
-                for i in self.domains[temp]:
-                    if i == v: count += 1
-                        
-                    elif self.crossword.overlaps[var, temp]:
-                        k, j = self.crossword.overlaps[var, temp]
-                        if v[k] != i[j]: count += 1
-            return count
-        
-        def _value(val):
-            count = 0
-            temp = self.domains[var].copy()
-            self.domains[var] = set([val])
-            
-            for i in self.crossword.neighbors(var):
-                if i in _vars: count += _neighbor(i, val)
-            self.domains[var] = temp
-            return count
-
         if not self.domains[var]: return []
-            
-        temp_domain = self.domains.copy()
 
-        for i in assignment: self.domains[i] = set([assignment[i]])
-            
+        # For each unassigned neighbor, the values of `var` rule out every
+        # word of the neighbor except those sharing the overlapping character
+        constraints = []
+        for n, k, j in self._overlaps[var]:
+            if n not in assignment:
+                constraints.append(
+                    (k, self._char_counts(n, j), len(self.domains[n]))
+                )
 
-        _vars = set(self.crossword.variables - set(assignment.keys()))
+        def _ruled_out(value):
+            return sum(
+                size - counts[value[k]] for k, counts, size in constraints
+            )
 
-        _val = sorted(self.domains[var], key = lambda value: _value(value))
-        
-        self.domains = temp_domain
-        
-        _val = self.domains[var].copy()
-        return _val
+        return sorted(self.domains[var], key=_ruled_out)
 
     def select_unassigned_variable(self, assignment):
         """
@@ -249,9 +378,11 @@ class CrosswordCreator():
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
         """
-        _vars = list(self.crossword.variables - set(assignment.keys()))
-        sorted_vars_left = sorted(_vars, key=lambda var: (len(self.domains[var]), -len(self.crossword.neighbors(var))))
-        return sorted_vars_left[0] if sorted_vars_left else None
+        return min(
+            (var for var in self.crossword.variables if var not in assignment),
+            key=lambda var: (len(self.domains[var]), -self._degree[var]),
+            default=None
+        )
 
     def backtrack(self, assignment):
         """
@@ -263,16 +394,108 @@ class CrosswordCreator():
         If no assignment is possible, return None.
         """
         if not self.consistent(assignment): return None
+
+        # Narrow assigned variables to their values so that arc consistency
+        # maintained during the search sees them as fixed. Counts cached by
+        # an earlier search may predate changes made to `self.domains`
+        self._char_cache = dict()
+        self._push_frame()
+        for var, value in assignment.items():
+            self._narrow(var, value)
+        result = self._backtrack(assignment, set(assignment.values()))
+        self._undo_frame()
+        return result
+
+    def _backtrack(self, assignment, used):
+        """
+        Recursive step of `backtrack`, for an assignment already known to be
+        consistent. `used` is the set of words currently in `assignment`.
+
+        Only the newly assigned variable can introduce a conflict, so each
+        candidate value is checked against its assigned neighbors alone.
+        After each assignment, arc consistency is restored on the arcs into
+        the new variable, and branches that empty a domain are skipped.
+        """
         if self.assignment_complete(assignment): return assignment
         _var = self.select_unassigned_variable(assignment)
         for i in self.order_domain_values(_var, assignment):
+            if i in used or len(i) != _var.length: continue
+            if not self._fits(_var, i, assignment): continue
+
             assignment[_var] = i
-            result = self.backtrack(assignment)
-            if result is not None: return result
-                
+            used.add(i)
+            self._push_frame()
+            self._narrow(_var, i)
+            arcs = [
+                (n, _var) for n in self._neighbors[_var]
+                if n not in assignment
+            ]
+            if self.ac3(arcs):
+                result = self._backtrack(assignment, used)
+                if result is not None:
+                    self._undo_frame()
+                    return result
+
+            self._undo_frame()
+            used.discard(i)
             del assignment[_var]
         return None
 
+    def _narrow(self, var, value):
+        """
+        Reduce the domain of `var` to `value`, recording the removed words
+        on the trail.
+        """
+        domain = self.domains[var]
+        removed = domain - {value}
+        if removed:
+            domain -= removed
+            self._trail.append((var, removed))
+            self._domain_version[var] += 1
+
+    def _fits(self, var, value, assignment):
+        """
+        Return True if `value` for `var` agrees with every assigned neighbor
+        of `var` on their overlapping characters.
+        """
+        for n, k, j in self._overlaps[var]:
+            if n in assignment:
+                if value[k] != assignment[n][j]: return False
+        return True
+
+
+# Creator shared by the branches run in a `solve_parallel` worker process
+_worker_creator = None
+
+
+def _init_worker(creator):
+    """
+    Store the creator that `solve_parallel` sends to each worker process.
+    """
+    global _worker_creator
+    _worker_creator = creator
+
+
+def _solve_branch(root, value):
+    """
+    Search the subtree of a `solve_parallel` problem in which `root` is
+    assigned `value`, on a private copy of the worker's domains.
+
+    Return a complete assignment, or None if the subtree has none.
+    """
+    creator = copy.copy(_worker_creator)
+    creator.domains = {
+        var: domain.copy() for var, domain in creator.domains.items()
+    }
+    creator._domain_version = creator._domain_version.copy()
+    creator._trail = []
+
+    creator.domains[root] = {value}
+    creator._domain_version[root] += 1
+    arcs = [(n, root) for n in creator._neighbors[root]]
+    if not creator.ac3(arcs): return None
+    return creator.backtrack({root: value})
+
 
 def main():
 